@@ -7,12 +7,22 @@ This script downloads the model, quantizes it, and converts it to MLX format.
 import os
 import sys
 import argparse
+import asyncio
+import hashlib
+import json
+import math
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
-import mlx.core as mx
-from mlx_lm import convert, generate
-from mlx_lm.utils import load
-import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Model configurations
 DEEPSEEK_MODELS = {
@@ -26,8 +36,90 @@ DEEPSEEK_MODELS = {
     }
 }
 
-def setup_environment():
-    """Setup the conversion environment."""
+# Quantization settings passed to mx.quantize for each level
+QUANTIZATION_CONFIGS = {
+    # 4-bit quantization for mobile devices
+    "q4": {"bits": 4, "group_size": 64},
+    # MXFP4 (E2M1 values, shared E8M0 scale per 32 weights) for mobile devices
+    "mxfp4": {"bits": 4, "group_size": 32, "mode": "mxfp4"},
+    # 8-bit quantization for better quality
+    "q8": {"bits": 8, "group_size": 64},
+    # 8-bit weights with bf16 activations (MLX quantized matmuls dequantize
+    # into the activation dtype); the largest group keeps scale overhead low
+    "w8a16": {"bits": 8, "group_size": 128},
+    # No quantization (full precision)
+    "none": {}
+}
+
+# Weight dtypes for --dtype, as mlx.core dtype names
+WEIGHT_DTYPES = {
+    "bf16": "bfloat16",
+    "fp16": "float16",
+    "fp32": "float32"
+}
+
+# Layers left unquantized - quantizing them costs a lot of quality for little size
+UNQUANTIZED_LAYER_PATTERNS = ("embed", "lm_head", "norm")
+
+# Non-weight files fetched before the weight shards
+METADATA_PATTERNS = ["*.json", "tokenizer*"]
+
+# Downloaded weight shards waiting for the converter
+DOWNLOAD_QUEUE_SIZE = 2
+
+# Converted weights are flushed to a new output shard past this size
+MAX_OUTPUT_SHARD_BYTES = 1 << 30
+
+# Context length the iOS memory estimate reserves KV cache for
+KV_CACHE_CONTEXT_TOKENS = 4096
+
+# Headroom on top of weights and KV cache for activations and the runtime
+MEMORY_OVERHEAD_FACTOR = 1.25
+
+# GPU working set (GB) needed to load and run each quantization level here
+# (bf16 for "none"); conversion itself is streamed and needs far less
+REQUIRED_WORKING_SET_GB = {
+    "q4": 6,
+    "mxfp4": 5,
+    "q8": 10,
+    "w8a16": 10,
+    "none": 18
+}
+
+# Test prompts for content analysis, generated together as one batch
+TEST_PROMPT_TEMPLATE = """
+Analyze this content and provide structured information:
+
+"{content}"
+
+Provide:
+- Category: 
+- Tags: 
+- Sentiment:
+"""
+
+TEST_CONTENTS = [
+    "Just discovered an amazing coffee shop downtown. Great atmosphere, excellent wifi, perfect for working. The barista recommended their signature blend - definitely coming back!",
+    "Meeting notes: moved the launch to next Friday, Sarah owns the release checklist and QA needs the final build by Wednesday.",
+    "Recipe idea: roasted chickpeas with smoked paprika, 200C for 25 minutes, shake halfway through. Crunchy snack for the week.",
+    "Flight was delayed three hours and the airline lost my luggage. Customer service was unhelpful and the refund form keeps failing."
+]
+
+TEST_PROMPTS = [TEST_PROMPT_TEMPLATE.format(content=content) for content in TEST_CONTENTS]
+
+# Tokens generated per test prompt
+TEST_MAX_TOKENS = 64
+
+# Tokenized TEST_PROMPTS, keyed by tokenizer name; each smoke test runs in
+# its own process, so this only saves re-tokenizing within one test
+_TEST_PROMPT_TOKENS = {}
+
+def setup_environment(quantizations=("q4",), dtype: str = "bf16", smoke_test: bool = False):
+    """Setup the conversion environment.
+
+    The GPU memory check only aborts when ``smoke_test`` is set, because only
+    the smoke test loads the model; the streamed conversion fits in far less.
+    """
     print("Setting up MLX environment...")
     
     # Verify MLX installation
@@ -41,24 +133,388 @@ def setup_environment():
         print("Install with: pip install mlx-lm")
         sys.exit(1)
     
-    # Check available memory
+    import mlx.core as mx
+    
+    # Check GPU memory before spending time on the download and conversion
     try:
-        available_memory = mx.get_active_memory() / (1024**3)  # GB
-        print(f"📊 Available GPU memory: {available_memory:.1f} GB")
-        
-        if available_memory < 8:
-            print("⚠️  Warning: Less than 8GB GPU memory available. Consider using smaller model.")
-            
+        device_info = getattr(mx, "device_info", None) or mx.metal.device_info
+        available_memory = device_info()["max_recommended_working_set_size"] / (1024**3)  # GB
     except Exception as e:
         print(f"⚠️  Could not check GPU memory: {e}")
+        return
+    
+    def required_memory_gb(quantization):
+        required = REQUIRED_WORKING_SET_GB[quantization]
+        if quantization == "none":
+            # Unquantized weights scale with --dtype
+            required *= getattr(mx, WEIGHT_DTYPES[dtype]).size / 2
+        return required
+    
+    largest = max(quantizations, key=required_memory_gb)
+    required_memory = required_memory_gb(largest)
+    print(f"📊 Available GPU memory: {available_memory:.1f} GB")
+    if available_memory < required_memory:
+        message = (f"{largest} needs {required_memory:g} GB of GPU memory to run, "
+                   f"only {available_memory:.1f} GB available.")
+        if smoke_test:
+            print(f"❌ {message} Consider a smaller quantization or skip --smoke-test.")
+            sys.exit(1)
+        print(f"⚠️  {message} Converting anyway, but the model cannot be tested here.")
+
+def write_json(path: Path, data: dict):
+    """Write data as indented JSON, using orjson when it is installed."""
+    if orjson is not None:
+        Path(path).write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS))
+    else:
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+
+def resolve_revision(hf_path: str, revision: str) -> str:
+    """Resolve a branch or tag on the Hugging Face Hub to its commit hash."""
+    try:
+        from huggingface_hub import HfApi
+        return HfApi().model_info(hf_path, revision=revision).sha
+    except Exception as e:
+        print(f"⚠️  Could not resolve revision '{revision}': {e}")
+        return revision
+
+def conversion_cache_key(hf_path: str, revision: str, quantization: str,
+                         dtype: str = "bf16") -> str:
+    """Build a short key identifying the source snapshot and conversion settings."""
+    import mlx.core as mx
+    import mlx_lm
+    q_config = QUANTIZATION_CONFIGS[quantization]
+    key = "|".join([
+        hf_path,
+        revision,
+        str(q_config.get("bits")),
+        str(q_config.get("group_size")),
+        q_config.get("mode", "affine"),
+        ",".join(UNQUANTIZED_LAYER_PATTERNS),
+        dtype,
+        mx.__version__,
+        mlx_lm.__version__
+    ])
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+def load_cached_model_info(model_path: Path, cache_key: str):
+    """Return the model info of a previous conversion with the same cache key."""
+    info_path = model_path / "model_info.json"
+    if not info_path.exists():
+        return None
+    try:
+        info = json.loads(info_path.read_text())
+    except ValueError:
+        return None
+    return info if info.get("cache_key") == cache_key else None
+
+def supports_quant_mode(mode: str) -> bool:
+    """Check whether the installed MLX supports the given quantization mode."""
+    import mlx.core as mx
+    try:
+        mx.eval(mx.quantize(mx.zeros((32, 32)), group_size=32, bits=4, mode=mode))
+        return True
+    except (TypeError, ValueError):
+        return False
+
+class SafetensorsWriter:
+    """Collects converted tensors and writes them out in bounded-size shards."""
+    
+    def __init__(self, output_path: Path, max_shard_bytes: int = MAX_OUTPUT_SHARD_BYTES):
+        self.output_path = output_path
+        self.max_shard_bytes = max_shard_bytes
+        self.pending = {}
+        self.pending_bytes = 0
+        self.weight_map = {}
+        self.total_size = 0
+        self.shard_count = 0
+    
+    def add(self, tensors: dict):
+        import mlx.core as mx
+        mx.eval(list(tensors.values()))
+        for name, tensor in tensors.items():
+            self.pending[name] = tensor
+            self.pending_bytes += tensor.nbytes
+        if self.pending_bytes >= self.max_shard_bytes:
+            self.flush()
+    
+    def flush(self):
+        if not self.pending:
+            return
+        import mlx.core as mx
+        self.shard_count += 1
+        shard_name = f"model-{self.shard_count:05d}.safetensors"
+        mx.save_safetensors(str(self.output_path / shard_name), self.pending,
+                            metadata={"format": "mlx"})
+        for name in self.pending:
+            self.weight_map[name] = shard_name
+        self.total_size += self.pending_bytes
+        self.pending = {}
+        self.pending_bytes = 0
+    
+    def close(self):
+        self.flush()
+        index = {
+            "metadata": {"total_size": self.total_size},
+            "weight_map": dict(sorted(self.weight_map.items()))
+        }
+        write_json(self.output_path / "model.safetensors.index.json", index)
+
+def decoder_only_predicate(name: str) -> bool:
+    """Quantize decoder linear layers only; embeddings, lm_head and norms stay unquantized."""
+    return not any(pattern in name for pattern in UNQUANTIZED_LAYER_PATTERNS)
+
+def quantize_tensor(name: str, weight, q_config: dict, quant_predicate=None) -> dict:
+    """Quantize a single weight the way nn.quantize would, if it is eligible."""
+    import mlx.core as mx
+    eligible = (
+        q_config
+        and (quant_predicate is None or quant_predicate(name))
+        and name.endswith(".weight")
+        and weight.ndim == 2
+        and weight.shape[-1] % q_config["group_size"] == 0
+    )
+    if not eligible:
+        return {name: weight}
+    
+    prefix = name[:-len(".weight")]
+    quantized = mx.quantize(weight, **q_config)
+    tensors = {name: quantized[0], f"{prefix}.scales": quantized[1]}
+    if len(quantized) > 2 and quantized[2] is not None:
+        tensors[f"{prefix}.biases"] = quantized[2]
+    return tensors
+
+class StreamConverter:
+    """Converts a Hugging Face checkpoint to MLX one tensor at a time.
+    
+    Unlike mlx_lm.convert, which builds the whole model in memory, each source
+    shard is loaded lazily and every tensor is quantized, evaluated and handed
+    to the writer before the next one is read. Peak memory is bounded by
+    MAX_OUTPUT_SHARD_BYTES instead of the model size, and shards can be fed
+    in any order as they become available. One converter writes one
+    quantization level; convert_shard feeds several from the same tensors.
+    
+    Floating point weights are cast to ``dtype`` directly, so no float32
+    copies are made on the way unless fp32 is requested.
+    """
+    
+    def __init__(self, model_path: str, output_path: str, q_config: dict,
+                 quant_predicate=None, dtype: str = "bf16"):
+        self.model_path = Path(model_path)
+        self.output_path = Path(output_path)
+        self.q_config = q_config
+        self.quant_predicate = quant_predicate
+        self.dtype = dtype
+        self.output_path.mkdir(parents=True, exist_ok=True)
+        
+        with open(self.model_path / "config.json") as f:
+            self.config = json.load(f)
+        
+        self.writer = SafetensorsWriter(self.output_path)
+    
+    def add_tensor(self, name: str, weight):
+        import mlx.core as mx
+        # Same cleanup as the mlx_lm model sanitizers
+        if "rotary_emb.inv_freq" in name:
+            return
+        if name == "lm_head.weight" and self.config.get("tie_word_embeddings"):
+            return
+        if mx.issubdtype(weight.dtype, mx.floating):
+            weight = weight.astype(getattr(mx, WEIGHT_DTYPES[self.dtype]))
+        self.writer.add(quantize_tensor(name, weight, self.q_config, self.quant_predicate))
+    
+    def close(self):
+        self.writer.close()
+        
+        config = dict(self.config)
+        config["torch_dtype"] = WEIGHT_DTYPES[self.dtype]
+        if self.q_config:
+            config["quantization"] = dict(self.q_config)
+            config["quantization_config"] = config["quantization"]
+        write_json(self.output_path / "config.json", config)
+        
+        # Tokenizer and generation configs are shared with the download cache
+        for path in self.model_path.iterdir():
+            if path.suffix == ".safetensors" or path.name in ("config.json", "model.safetensors.index.json"):
+                continue
+            if path.is_file():
+                link_or_copy(path, self.output_path / path.name)
+
+def link_or_copy(source: Path, destination: Path):
+    """Hardlink a file, copying it when the link cannot be made (e.g. across filesystems)."""
+    try:
+        os.link(source.resolve(), destination)
+    except OSError:
+        shutil.copy(source, destination)
+
+def convert_shard(shard_path: str, converters: list):
+    """Feed every tensor of a source shard to each converter, reading it only once."""
+    import mlx.core as mx
+    print(f"   Converting {Path(shard_path).name}...")
+    weights = mx.load(str(shard_path))
+    for name in sorted(weights):
+        weight = weights.pop(name)
+        # Materialize the source tensor once and share it between all levels
+        mx.eval(weight)
+        for converter in converters:
+            converter.add_tensor(name, weight)
+        del weight
+    del weights
 
-def convert_model_to_mlx(model_name: str, output_dir: str, quantization: str = "q4"):
-    """Convert DeepSeek model to MLX format with quantization."""
+def list_weight_shards(model_path: str) -> list:
+    """List the weight shards of a checkpoint from its safetensors index.
+
+    The index comes with the metadata files, so this needs no network access.
+    Checkpoints without an index consist of a single model.safetensors.
+    """
+    index_path = Path(model_path) / "model.safetensors.index.json"
+    if not index_path.exists():
+        return ["model.safetensors"]
+    weight_map = json.loads(index_path.read_text()).get("weight_map", {})
+    shards = sorted(set(weight_map.values()))
+    if not shards:
+        raise ValueError(f"No weight shards listed in {index_path}")
+    return shards
+
+async def download_and_convert(hf_path: str, revision: str, outputs: dict,
+                               quant_predicate=None, dtype: str = "bf16", max_workers: int = 8):
+    """Download the model and convert it, overlapping the two phases.
+    
+    ``outputs`` maps each output directory to the quantization config to
+    write there; all of them are converted in the same pass over the weights.
+    
+    Configs and tokenizer files are fetched first. The weight shards are then
+    downloaded concurrently, at most ``max_workers`` at a time, and each one
+    is converted as soon as it lands while the rest are still downloading.
+    Files already in the Hugging Face cache are skipped and interrupted
+    downloads are resumed. Returns the local snapshot path.
+    """
+    from huggingface_hub import hf_hub_download, snapshot_download
+    
+    model_path = await asyncio.to_thread(
+        snapshot_download,
+        repo_id=hf_path,
+        revision=revision,
+        max_workers=max_workers,
+        allow_patterns=METADATA_PATTERNS
+    )
+    shards = list_weight_shards(model_path)
+    
+    converters = [
+        StreamConverter(model_path, output_path, q_config, quant_predicate, dtype)
+        for output_path, q_config in outputs.items()
+    ]
+    queue = asyncio.Queue(maxsize=DOWNLOAD_QUEUE_SIZE)
+    semaphore = asyncio.Semaphore(max_workers)
+    loop = asyncio.get_running_loop()
+    
+    async def download(filename: str):
+        async with semaphore:
+            path = await asyncio.to_thread(
+                hf_hub_download,
+                repo_id=hf_path,
+                filename=filename,
+                revision=revision
+            )
+        await queue.put(path)
+    
+    async def convert_worker():
+        # All MLX work stays on one thread, in the order shards finish downloading
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            for _ in shards:
+                path = await queue.get()
+                await loop.run_in_executor(executor, convert_shard, path, converters)
+            for converter in converters:
+                await loop.run_in_executor(executor, converter.close)
+    
+    await asyncio.gather(convert_worker(), *(download(shard) for shard in shards))
+    return model_path
+
+def publish_conversion(staging_path: Path, output_path: Path, cache_key: str):
+    """Move a finished conversion from its staging directory to the cached path."""
+    # mkdtemp creates the directory owner-only
+    staging_path.chmod(0o755)
+    if output_path.exists() and load_cached_model_info(output_path, cache_key) is None:
+        # Output of an interrupted run of an older version of this script
+        shutil.rmtree(output_path)
+    try:
+        os.replace(staging_path, output_path)
+    except OSError:
+        # Another run published the same conversion first
+        if load_cached_model_info(output_path, cache_key) is None:
+            raise
+        print("♻️  Conversion was published by another run, keeping that one")
+
+def resolve_quantization_level(quantization: str) -> str:
+    """Return the level that will actually be converted for the requested one."""
+    q_config = QUANTIZATION_CONFIGS[quantization]
+    if "mode" in q_config and not supports_quant_mode(q_config["mode"]):
+        # Older MLX without this mode - fall back to affine 4-bit
+        print(f"⚠️  Installed MLX does not support {quantization}, falling back to q4")
+        return "q4"
+    return quantization
+
+def convert_variants(hf_path: str, model_name: str, revision: str, pending: dict,
+                     output_paths: dict, dtype: str = "bf16", download_workers: int = 8):
+    """Convert the pending quantization levels in one pass and publish them.
+
+    ``pending`` maps each level to its cache key. Every level is written to
+    a fresh staging directory (mkdtemp creates it atomically) and moved into
+    place only once it is complete.
+    """
+    staging_paths = {}
+    try:
+        outputs = {}
+        for quantization in pending:
+            output_path = output_paths[quantization]
+            output_path.parent.mkdir(parents=True, exist_ok=True)
+            staging_paths[quantization] = Path(tempfile.mkdtemp(prefix=f"{output_path.name}_",
+                                                                dir=str(output_path.parent)))
+            outputs[str(staging_paths[quantization])] = QUANTIZATION_CONFIGS[quantization]
+        
+        # Convert with quantization for mobile deployment
+        print(f"⚙️  Downloading and converting ({download_workers} download workers)...")
+        asyncio.run(download_and_convert(
+            hf_path,
+            revision,
+            outputs,
+            decoder_only_predicate,
+            dtype=dtype,
+            max_workers=download_workers
+        ))
+        
+        print("✅ Model conversion completed!")
+        
+        for quantization, cache_key in pending.items():
+            # Generate model info
+            generate_model_info(str(output_paths[quantization]), model_name, quantization,
+                                revision=revision, cache_key=cache_key,
+                                dtype=dtype, info_dir=str(staging_paths[quantization]))
+            
+            publish_conversion(staging_paths[quantization], output_paths[quantization], cache_key)
+    finally:
+        for staging_path in staging_paths.values():
+            if staging_path.exists():
+                shutil.rmtree(staging_path)
+
+def convert_model_to_mlx(model_name: str, output_dir: str, quantizations=("q4",),
+                         smoke_test: bool = False, revision: str = "main",
+                         download_workers: int = 8, dtype: str = "bf16"):
+    """Convert DeepSeek model to MLX format, once per quantization level.
+
+    All levels are converted together, so the model is downloaded and read
+    once however many are requested. Conversions are cached by source
+    snapshot and settings, so each level goes to
+    ``<output_dir>_<quantization>_<cache_key>``. Returns the output paths,
+    or None on failure.
+    """
+    if isinstance(quantizations, str):
+        quantizations = [quantizations]
     
     if model_name not in DEEPSEEK_MODELS:
         print(f"❌ Unknown model: {model_name}")
         print(f"Available models: {list(DEEPSEEK_MODELS.keys())}")
-        return False
+        return None
     
     config = DEEPSEEK_MODELS[model_name]
     hf_path = config["hf_path"]
@@ -66,119 +522,198 @@ def convert_model_to_mlx(model_name: str, output_dir: str, quantization: str = "
     print(f"🔄 Converting {config['description']}")
     print(f"📥 Source: {hf_path}")
     print(f"📤 Output: {output_dir}")
-    print(f"🔢 Quantization: {quantization}")
+    print(f"🔢 Quantization: {', '.join(quantizations)}")
     
     try:
-        # Create output directory with timestamp to avoid conflicts
-        import tempfile
-        import random
-        
-        # Use a completely unique temporary approach
-        temp_suffix = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{random.randint(1000, 9999)}"
+        revision = resolve_revision(hf_path, revision)
         base_output_path = Path(output_dir)
-        output_path = base_output_path.parent / f"{base_output_path.name}_{temp_suffix}"
-        
-        # Ensure the directory doesn't exist
-        while output_path.exists():
-            temp_suffix = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{random.randint(1000, 9999)}"
-            output_path = base_output_path.parent / f"{base_output_path.name}_{temp_suffix}"
-        
-        print(f"📤 Actual output: {output_path}")
-        # Don't create the directory - let convert() do it
-        
-        # Convert with quantization for mobile deployment
-        print("⚙️  Starting conversion...")
         
-        if quantization == "q4":
-            # 4-bit quantization for mobile devices
-            convert(
-                hf_path,
-                mlx_path=str(output_path),
-                quantize=True,
-                q_bits=4,
-                q_group_size=64
-            )
-        elif quantization == "q8":
-            # 8-bit quantization for better quality
-            convert(
-                hf_path,
-                mlx_path=str(output_path),
-                quantize=True,
-                q_bits=8,
-                q_group_size=64
-            )
-        else:
-            # No quantization (full precision)
-            convert(
-                hf_path,
-                mlx_path=str(output_path),
-                quantize=False
-            )
+        # Levels the installed MLX cannot produce are replaced before the
+        # cache lookup, so outputs are always keyed by what was converted
+        levels = list(dict.fromkeys(resolve_quantization_level(q) for q in quantizations))
         
-        print("✅ Model conversion completed!")
+        output_paths = {}
+        pending = {}
+        for quantization in levels:
+            cache_key = conversion_cache_key(hf_path, revision, quantization, dtype)
+            output_path = base_output_path.parent / f"{base_output_path.name}_{quantization}_{cache_key}"
+            output_paths[quantization] = output_path
+            print(f"📤 Actual {quantization} output: {output_path}")
+            
+            if load_cached_model_info(output_path, cache_key) is not None:
+                print(f"♻️  Found cached {quantization} conversion, skipping it")
+            else:
+                pending[quantization] = cache_key
         
-        # Test the converted model
-        print("🧪 Testing converted model...")
-        test_model(str(output_path))
+        if pending:
+            convert_variants(hf_path, model_name, revision, pending, output_paths,
+                             dtype=dtype, download_workers=download_workers)
         
-        # Generate model info
-        generate_model_info(str(output_path), model_name, quantization)
+        # Test the converted models
+        if smoke_test:
+            for quantization, output_path in output_paths.items():
+                print(f"🧪 Testing converted {quantization} model...")
+                test_model(str(output_path))
         
-        return True
+        return [str(output_path) for output_path in output_paths.values()]
         
     except Exception as e:
         print(f"❌ Conversion failed: {e}")
-        return False
+        return None
 
 def test_model(model_path: str):
-    """Test the converted model with a simple prompt."""
+    """Test the converted model with the test prompts in a separate process.
+
+    Running the test in a child interpreter keeps the loaded weights out of
+    the converter process, so their memory is released as soon as it exits.
+    """
+    script_dir = str(Path(__file__).resolve().parent)
+    code = (
+        f"import sys; sys.path.insert(0, {script_dir!r}); "
+        f"import convert_deepseek_model; "
+        f"convert_deepseek_model.run_model_test({model_path!r})"
+    )
+    result = subprocess.run([sys.executable, "-c", code], check=False)
+    if result.returncode != 0:
+        print(f"⚠️  Model test failed (exit code {result.returncode})")
+
+def encode_test_prompts(tokenizer):
+    """Tokenize TEST_PROMPTS once and reuse the ids for warmup and the test run."""
+    key = getattr(tokenizer, "name_or_path", None) or id(tokenizer)
+    if key not in _TEST_PROMPT_TOKENS:
+        _TEST_PROMPT_TOKENS[key] = [tokenizer.encode(prompt) for prompt in TEST_PROMPTS]
+    return _TEST_PROMPT_TOKENS[key]
+
+def warmup_model(model, tokenizer):
+    """Run the model once so the smoke test measures steady-state decoding.
+
+    A plain forward pass over the first test prompt evaluates the weights and
+    builds the kernels the prefill uses, and a 1-token generate() does the
+    same for the decode path with a KV cache.
+    """
+    import mlx.core as mx
+    from mlx_lm import generate
+    
+    prompt_tokens = encode_test_prompts(tokenizer)[0]
+    mx.eval(model(mx.array(prompt_tokens)[None]))
+    generate(model, tokenizer, prompt=prompt_tokens, max_tokens=1)
+
+def run_model_test(model_path: str):
+    """Load the converted model, run the test prompts and record the throughput."""
     try:
+        from mlx_lm import generate
+        from mlx_lm.utils import load
+        
         print("Loading model for testing...")
         model, tokenizer = load(model_path)
         
-        # Test prompt for content analysis
-        test_prompt = """
-        Analyze this content and provide structured information:
+        # Default sampling is greedy (temp=0.0), which keeps the output deterministic
+        try:
+            from mlx_lm import batch_generate
+        except ImportError:
+            batch_generate = None
         
-        "Just discovered an amazing coffee shop downtown. Great atmosphere, excellent wifi, perfect for working. The barista recommended their signature blend - definitely coming back!"
+        # Warm up so graph building, kernel compilation and tokenizer
+        # setup are not part of the test generation
+        print("🔥 Warming up...")
+        warmup_model(model, tokenizer)
         
-        Provide:
-        - Category: 
-        - Tags: 
-        - Sentiment:
-        """
+        print(f"🔄 Generating {len(TEST_PROMPTS)} test responses...")
+        prompt_tokens = encode_test_prompts(tokenizer)
+        start = time.perf_counter()
+        if batch_generate is not None:
+            # One padded batch per decode step instead of one sequence at a time
+            batch_size = len(TEST_PROMPTS)
+            responses = batch_generate(
+                model,
+                tokenizer,
+                prompts=prompt_tokens,
+                max_tokens=TEST_MAX_TOKENS
+            ).texts
+        else:
+            # Older mlx_lm: generate sequentially with the already loaded model
+            batch_size = 1
+            responses = [
+                generate(model, tokenizer, prompt=tokens, max_tokens=TEST_MAX_TOKENS)
+                for tokens in prompt_tokens
+            ]
+        elapsed = time.perf_counter() - start
         
-        print("🔄 Generating test response...")
-        response = generate(
-            model, 
-            tokenizer, 
-            prompt=test_prompt,
-            max_tokens=200,
-            temp=0.3
+        # Count what was actually generated, sequences can stop early at EOS
+        generated_tokens = sum(
+            len(tokenizer.encode(response, add_special_tokens=False)) for response in responses
         )
+        tokens_per_sec = generated_tokens / elapsed
+        print(f"⏱️  {tokens_per_sec:.1f} tok/s at batch size {batch_size} "
+              f"({tokens_per_sec / batch_size:.1f} tok/s per sample)")
+        record_throughput(model_path, batch_size, tokens_per_sec)
         
         print("📝 Test output:")
-        print("-" * 50)
-        print(response)
+        for response in responses:
+            print("-" * 50)
+            print(response)
         print("-" * 50)
         print("✅ Model test successful!")
         
     except Exception as e:
         print(f"⚠️  Model test failed: {e}")
+        sys.exit(1)
 
-def generate_model_info(model_path: str, model_name: str, quantization: str):
-    """Generate model info file for iOS app."""
+def record_throughput(model_path: str, batch_size: int, tokens_per_sec: float):
+    """Store the smoke test throughput in the model's model_info.json."""
+    info_path = Path(model_path) / "model_info.json"
+    if not info_path.exists():
+        return
+    info = json.loads(info_path.read_text())
+    info["throughput_tokens_per_sec_smoke"] = round(tokens_per_sec, 1)
+    info["throughput_smoke_batch_size"] = batch_size
+    write_json(info_path, info)
+
+def estimate_min_memory_gb(model_path: str, dtype: str = "bf16") -> int:
+    """Estimate the memory needed to run the model from its converted files.
+
+    Adds the on-disk size of the weights to a KV cache for
+    KV_CACHE_CONTEXT_TOKENS tokens sized from config.json.
+    """
+    import mlx.core as mx
+    model_path = Path(model_path)
+    weight_bytes = sum(path.stat().st_size for path in model_path.rglob("*.safetensors"))
+    
+    config = json.loads((model_path / "config.json").read_text())
+    num_heads = config["num_attention_heads"]
+    num_kv_heads = config.get("num_key_value_heads", num_heads)
+    head_dim = config.get("head_dim") or config["hidden_size"] // num_heads
+    bytes_per_element = getattr(mx, WEIGHT_DTYPES[dtype]).size
+    # Keys and values for every layer
+    kv_bytes = (2 * config["num_hidden_layers"] * num_kv_heads * head_dim
+                * KV_CACHE_CONTEXT_TOKENS * bytes_per_element)
+    
+    return math.ceil((weight_bytes + kv_bytes) / (1024**3) * MEMORY_OVERHEAD_FACTOR)
+
+def generate_model_info(model_path: str, model_name: str, quantization: str,
+                        revision: str = None, cache_key: str = None,
+                        dtype: str = "bf16", info_dir: str = None):
+    """Generate model info file for iOS app.
+
+    The file is written to ``info_dir`` when given (e.g. a staging directory
+    that is later moved to ``model_path``), otherwise into ``model_path``.
+    """
+    files_dir = info_dir or model_path
     info = {
         "model_name": model_name,
         "model_path": model_path,
         "quantization": quantization,
+        "unquantized_layers": list(UNQUANTIZED_LAYER_PATTERNS) if quantization != "none" else [],
         "framework": "MLX",
         "target_platform": "iOS",
+        "revision": revision,
+        "cache_key": cache_key,
         "converted_at": datetime.now().isoformat(),
         "description": DEEPSEEK_MODELS[model_name]["description"],
         "usage": {
             "min_ios_version": "16.0",
-            "min_memory_gb": 8 if quantization == "q4" else 12,
+            "min_memory_gb": estimate_min_memory_gb(files_dir, dtype),
+            "weight_dtype": WEIGHT_DTYPES[dtype],
             "recommended_devices": [
                 "iPhone 15 Pro",
                 "iPhone 15 Pro Max", 
@@ -188,10 +723,8 @@ def generate_model_info(model_path: str, model_name: str, quantization: str):
         }
     }
     
-    import json
-    info_path = Path(model_path) / "model_info.json"
-    with open(info_path, 'w') as f:
-        json.dump(info, f, indent=2)
+    info_path = Path(files_dir) / "model_info.json"
+    write_json(info_path, info)
     
     print(f"📋 Model info saved to: {info_path}")
 
@@ -200,6 +733,8 @@ def optimize_for_ios(model_path: str):
     print("🍎 Applying iOS optimizations...")
     
     try:
+        from mlx_lm.utils import load
+        
         # Load model for optimization
         model, tokenizer = load(model_path)
         
@@ -214,6 +749,15 @@ def optimize_for_ios(model_path: str):
     except Exception as e:
         print(f"⚠️  iOS optimization failed: {e}")
 
+def parse_quantizations(value: str) -> list:
+    """Parse a comma-separated list of quantization levels."""
+    quantizations = [level.strip() for level in value.split(",") if level.strip()]
+    unknown = [level for level in quantizations if level not in QUANTIZATION_CONFIGS]
+    if not quantizations or unknown:
+        raise argparse.ArgumentTypeError(
+            f"invalid level(s) {unknown or value!r}, choose from {list(QUANTIZATION_CONFIGS.keys())}")
+    return list(dict.fromkeys(quantizations))
+
 def main():
     parser = argparse.ArgumentParser(description="Convert DeepSeek-R1 models to MLX format for iOS")
     parser.add_argument("--model", 
@@ -224,12 +768,27 @@ def main():
                        default="./models/deepseek-r1-8b-mlx",
                        help="Output directory")
     parser.add_argument("--quantization",
-                       choices=["q4", "q8", "none"],
+                       type=parse_quantizations,
                        default="q4", 
-                       help="Quantization level")
+                       help="Quantization level, or a comma-separated list to convert in one run "
+                            f"({', '.join(QUANTIZATION_CONFIGS.keys())})")
+    parser.add_argument("--dtype",
+                       choices=list(WEIGHT_DTYPES.keys()),
+                       default="bf16",
+                       help="Dtype for unquantized weights and quantization scales")
+    parser.add_argument("--revision",
+                       default="main",
+                       help="Hugging Face branch, tag or commit to convert")
+    parser.add_argument("--download-workers",
+                       type=int,
+                       default=8,
+                       help="Parallel workers for downloading model files")
     parser.add_argument("--optimize-ios",
                        action="store_true",
                        help="Apply iOS-specific optimizations")
+    parser.add_argument("--smoke-test",
+                       action="store_true",
+                       help="Run a short generation with the converted model")
     
     args = parser.parse_args()
     
@@ -237,21 +796,27 @@ def main():
     print("=" * 50)
     
     # Setup environment
-    setup_environment()
+    setup_environment(args.quantization, dtype=args.dtype, smoke_test=args.smoke_test)
     
     # Convert model
-    success = convert_model_to_mlx(
+    output_paths = convert_model_to_mlx(
         args.model,
         args.output,
-        args.quantization
+        args.quantization,
+        smoke_test=args.smoke_test,
+        revision=args.revision,
+        download_workers=args.download_workers,
+        dtype=args.dtype
     )
     
-    if success and args.optimize_ios:
-        optimize_for_ios(args.output)
+    if output_paths and args.optimize_ios:
+        for output_path in output_paths:
+            optimize_for_ios(output_path)
     
-    if success:
+    if output_paths:
         print("\n🎉 Conversion completed successfully!")
-        print(f"📱 Model ready for iOS deployment: {args.output}")
+        for output_path in output_paths:
+            print(f"📱 Model ready for iOS deployment: {output_path}")
         print("\nNext steps:")
         print("1. Copy model files to iOS app bundle")
         print("2. Update MLXManager.swift with model path")